@@ -1,18 +1,34 @@
 # planning_agent/agent.py
 
 import os
+import math
+import logging
 import googlemaps
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import diskcache
+import aiohttp
+from aiolimiter import AsyncLimiter
 import json
+import orjson
 from dotenv import load_dotenv
-from functools import lru_cache
-import google.generativeai as genai
+from functools import cache, lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import TYPE_CHECKING
 import re
 import asyncio
-from google.adk.sessions import InMemorySessionService
-from google.adk.runners import Runner
-from google.genai import types
+import numpy as np
+import ahocorasick
 
+if TYPE_CHECKING:
+    # Annotation only; ADK itself is imported when the agent is built
+    from google.adk.agents import LlmAgent
+
+
+log = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
@@ -20,16 +36,77 @@ load_dotenv()
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-# Initialize clients only if API keys are available
-gmaps = None
-if GOOGLE_MAPS_API_KEY:
-    gmaps = googlemaps.Client(key=GOOGLE_MAPS_API_KEY)
-    genai.configure(api_key=GOOGLE_API_KEY)
+# Clients are created on first use so importing the module stays cheap
+@cache
+def gmaps_client():
+    """Return the shared googlemaps client, or None when GOOGLE_MAPS_API_KEY is not set."""
+    if not GOOGLE_MAPS_API_KEY:
+        return None
+    return googlemaps.Client(key=GOOGLE_MAPS_API_KEY)
+
+@cache
+def configure_genai():
+    """Configure the Gemini SDK once, if GOOGLE_API_KEY is set."""
+    if GOOGLE_API_KEY:
+        import google.generativeai as genai
+        genai.configure(api_key=GOOGLE_API_KEY)
+
+# Shared HTTP session so Places calls reuse keep-alive connections instead of a new TCP/TLS handshake each
+HTTP_TIMEOUT = 5  # seconds
+
+@cache
+def _http_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=50,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+    ))
+    return session
+
+# Maps responses are persisted on disk, shared by the sync helpers and the async fan-out,
+# so repeated queries skip the paid API across runs and worker processes
+GMAPS_CACHE_PATH = os.path.expanduser(os.getenv("GMAPS_CACHE_PATH", "~/.itinerary_cache"))
+
+# Per-endpoint TTLs in seconds, all well under Google's 30-day caching limit
+CACHE_TTLS = {
+    "details": 7 * 24 * 3600,
+    "nearbysearch": 3600,
+    "textsearch": 3600,
+    "autocomplete": 600,
+    "directions": 6 * 3600,
+}
+
+@cache
+def _disk_cache():
+    return diskcache.Cache(GMAPS_CACHE_PATH, size_limit=2**30)
+
+def _cache_key(endpoint, params):
+    # Canonical, key-free parameters; nearby-search coordinates are already quantized by the callers
+    return (endpoint, tuple(sorted((name, str(value)) for name, value in params.items())))
+
+def _cache_lookup(endpoint, params):
+    cached = _disk_cache().get(_cache_key(endpoint, params))
+    return None if cached is None else orjson.loads(cached)
+
+# Only real answers are cached; errors and throttling (even with HTTP 200) must be retried
+CACHEABLE_STATUSES = ("OK", "ZERO_RESULTS")
+
+def _cache_store(endpoint, params, res):
+    if res.get("status") in CACHEABLE_STATUSES:
+        _disk_cache().set(_cache_key(endpoint, params), orjson.dumps(res), expire=CACHE_TTLS.get(endpoint, 3600))
 
-def get_directions(origin, destination, waypoints=None):
+def get_directions(origin, destination, waypoints=None, no_cache=False):
     """
     Get optimized directions between origin and destination with optional waypoints.
     """
+    params = {"origin": origin, "destination": destination, "waypoints": waypoints or ""}
+    if not no_cache:
+        cached = _cache_lookup("directions", params)
+        if cached is not None:
+            return cached["routes"]
+    
+    gmaps = gmaps_client()
     if not gmaps:
         raise ValueError("Google Maps client not initialized. Please set GOOGLE_API_KEY environment variable.")
     
@@ -40,12 +117,15 @@ def get_directions(origin, destination, waypoints=None):
         optimize_waypoints=True,
         mode="driving"
     )
+    # Stored in the Places response shape so the shared cache helpers apply unchanged
+    _cache_store("directions", params, {"status": "OK" if directions_result else "ZERO_RESULTS", "routes": directions_result})
     return directions_result
 
 def get_places(location, radius=1000, place_type="cafe"):
     """
     Get nearby places (like cafes, restaurants) around a location.
     """
+    gmaps = gmaps_client()
     if not gmaps:
         raise ValueError("Google Maps client not initialized. Please set GOOGLE_API_KEY environment variable.")
     
@@ -56,293 +136,714 @@ def get_places(location, radius=1000, place_type="cafe"):
     )
     return places_result
 
+class _NotMemoized(Exception):
+    """Carries a failed Places response out of an lru_cache wrapper so it is not memoized"""
+    def __init__(self, res):
+        super().__init__(res.get("status"))
+        self.res = res
+
+def _memoizable(res):
+    # Same rule as _cache_store: errors and throttling (even with HTTP 200) must be retried
+    if res.get("status") not in CACHEABLE_STATUSES:
+        raise _NotMemoized(res)
+    return res
+
+def _memoized_response(cached_func, *args):
+    try:
+        return cached_func(*args)
+    except _NotMemoized as e:
+        return e.res
+
 # Additional API functions moved from UI layer
 @lru_cache(maxsize=500)
+def _cached_place_details_response(place_id):
+    return _memoizable(_place_details_response(place_id))
+
 def cached_place_details(place_id):
-    return get_place_details(place_id)
+    return _memoized_response(_cached_place_details_response, place_id).get("result", {})
+
+# Cache keys use coordinates quantized to 1e-4 degrees (~11 m) so float noise between
+# close-by route points doesn't defeat the LRU
+COORD_QUANTUM = 1e4
+
+def _quantize(lat, lng):
+    return round(lat * COORD_QUANTUM), round(lng * COORD_QUANTUM)
+
+@lru_cache(maxsize=200)
+def _cached_nearby_search_quantized(lat_q, lng_q, poi_type, radius):
+    return _memoizable(_places_nearby_response(lat_q / COORD_QUANTUM, lng_q / COORD_QUANTUM, poi_type, radius))
 
-@lru_cache(maxsize=200)  
 def cached_nearby_search(lat, lng, poi_type, radius=1000):
-    return get_places_nearby(lat, lng, poi_type, radius)
+    return _memoized_response(_cached_nearby_search_quantized, *_quantize(lat, lng), poi_type, radius).get("results", [])
+
+PLACES_API_URL = "https://maps.googleapis.com/maps/api/place"
+PLACE_DETAILS_FIELDS = "geometry,name,rating,price_level,opening_hours,photos,types,formatted_address"
+
+def _gmaps_get(endpoint, params, no_cache=False):
+    """GET a Places web-service endpoint through the disk cache, decoding with orjson."""
+    if not no_cache:
+        cached = _cache_lookup(endpoint, params)
+        if cached is not None:
+            return cached
+    
+    response = _http_session().get(
+        f"{PLACES_API_URL}/{endpoint}/json",
+        params={**params, "key": GOOGLE_MAPS_API_KEY},
+        timeout=HTTP_TIMEOUT
+    )
+    response.raise_for_status()
+    res = orjson.loads(response.content)
+    
+    # Places reports API errors (bad key, quota, invalid request) in the body with HTTP 200
+    if res.get("status") not in CACHEABLE_STATUSES:
+        log.warning("Google Maps %s returned %s: %s", endpoint, res.get("status"), res.get("error_message", ""))
+    _cache_store(endpoint, params, res)
+    return res
 
-def get_place_details(place_id):
-    url = f"https://maps.googleapis.com/maps/api/place/details/json"
+def _place_details_response(place_id, no_cache=False):
     params = {
         "place_id": place_id, 
-        "key": GOOGLE_MAPS_API_KEY,
-        "fields": "geometry,name,rating,price_level,opening_hours,photos,types,formatted_address"
+        "fields": PLACE_DETAILS_FIELDS
     }
-    res = requests.get(url, params=params).json()
-    return res.get("result", {})
+    return _gmaps_get("details", params, no_cache)
 
-def get_places_nearby(lat, lng, poi_type, radius=1000):
-    """Get nearby places of specific type"""
-    url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+def get_place_details(place_id, no_cache=False):
+    return _place_details_response(place_id, no_cache).get("result", {})
+
+def _places_nearby_response(lat, lng, poi_type, radius=1000, no_cache=False):
     params = {
         "location": f"{lat},{lng}",
         "radius": radius,
-        "type": poi_type,
-        "key": GOOGLE_MAPS_API_KEY
+        "type": poi_type
     }
-    res = requests.get(url, params=params).json()
-    return res.get("results", [])
+    return _gmaps_get("nearbysearch", params, no_cache)
+
+def get_places_nearby(lat, lng, poi_type, radius=1000, no_cache=False):
+    """Get nearby places of specific type"""
+    return _places_nearby_response(lat, lng, poi_type, radius, no_cache).get("results", [])
 
-def get_places_text_search(query, lat, lng, radius=5000):
+def get_places_text_search(query, lat, lng, radius=5000, no_cache=False):
     """Fallback text search for POIs"""
-    url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
     params = {
         "query": query,
         "location": f"{lat},{lng}",
-        "radius": radius,
-        "key": GOOGLE_MAPS_API_KEY
+        "radius": radius
     }
-    res = requests.get(url, params=params).json()
+    res = _gmaps_get("textsearch", params, no_cache)
     return res.get("results", [])
 
-def get_place_autocomplete(query):
-    url = f"https://maps.googleapis.com/maps/api/place/autocomplete/json"
+def get_place_autocomplete(query, no_cache=False):
     params = {
         "input": query,
-        "key": GOOGLE_MAPS_API_KEY,
         "types": "geocode"
     }
-    res = requests.get(url, params=params).json()
+    res = _gmaps_get("autocomplete", params, no_cache)
     return res.get("predictions", [])
 
-def sample_route_points(directions_result, interval_meters=500):
-    """Sample points along route polyline every interval_meters"""
+ROUTE_GRID_DECIMALS = 3  # ~110 m cells, well inside the 1000 m nearby-search radius
+
+def dedupe_route_points(route_points):
+    """Keep the first (lat, lng) point in each grid cell, preserving route order"""
+    unique_points = {}
+    for lat, lng in route_points:
+        unique_points.setdefault((round(lat, ROUTE_GRID_DECIMALS), round(lng, ROUTE_GRID_DECIMALS)), (lat, lng))
+    return list(unique_points.values())
+
+EARTH_RADIUS_M = 6371008.8
+ROUTE_SAMPLE_INTERVAL_M = 2000  # Twice the 1000 m nearby-search radius, so consecutive search circles touch
+MAX_ROUTE_SAMPLES = 50  # Long routes spread their samples wider so the fan-out and prompt stay bounded
+
+def _haversine_m(lats1, lngs1, lats2, lngs2):
+    """Vectorized great-circle distance in metres between paired points."""
+    lats1, lngs1, lats2, lngs2 = map(np.radians, (lats1, lngs1, lats2, lngs2))
+    a = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lngs2 - lngs1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+def _step_endpoints(route):
+    """Step start locations plus the final destination, for routes without an overview polyline"""
+    points = [(step['start_location']['lat'], step['start_location']['lng']) for leg in route['legs'] for step in leg['steps']]
+    end = route['legs'][-1]['end_location']
+    points.append((end['lat'], end['lng']))
+    return points
+
+def sample_route_points(directions_result, interval_meters=ROUTE_SAMPLE_INTERVAL_M, max_points=MAX_ROUTE_SAMPLES):
+    """Sample points along route polyline every interval_meters (wider when that exceeds max_points)"""
     if not directions_result:
         return []
     
     route = directions_result[0]
-    points = []
+    encoded = route.get('overview_polyline', {}).get('points')
+    if not encoded:
+        return dedupe_route_points(_step_endpoints(route))
     
-    for leg in route['legs']:
-        for step in leg['steps']:
-            # Add step start location
-            start = step['start_location']
-            points.append((start['lat'], start['lng']))
-            
-            # TODO: Add intermediate points along step polyline based on interval
-            # For now, just using step endpoints
+    path = googlemaps.convert.decode_polyline(encoded)
+    lats = np.fromiter((p['lat'] for p in path), dtype=np.float64, count=len(path))
+    lngs = np.fromiter((p['lng'] for p in path), dtype=np.float64, count=len(path))
     
-    # Add final destination
-    final_leg = route['legs'][-1]
-    end = final_leg['end_location'] 
-    points.append((end['lat'], end['lng']))
+    # Cumulative distance along the path, then a point interpolated at each interval mark, so
+    # sparse stretches (long highway segments) are covered as evenly as dense city streets
+    cumulative = np.concatenate(([0.0], np.cumsum(_haversine_m(lats[:-1], lngs[:-1], lats[1:], lngs[1:]))))
+    interval_meters = max(interval_meters, cumulative[-1] / max(max_points - 1, 1))
+    marks = np.append(np.arange(0, cumulative[-1], interval_meters), cumulative[-1])  # Always keep the destination
+    sample_lats = np.interp(marks, cumulative, lats)
+    sample_lngs = np.interp(marks, cumulative, lngs)
     
-    return points
+    # The destination can land within one grid cell of the last mark
+    return dedupe_route_points(zip(sample_lats.tolist(), sample_lngs.tolist()))
 
-def get_pois_along_route(route_points, search_terms, threshold=5):
-    """Get POIs along route points using flexible search terms
+# Async fan-out used by the route POI search
+MAX_CONCURRENT_REQUESTS = 20  # Keep bursts within Google Places QPS quotas
+RATE_LIMIT_RETRIES = 3
+# Per-request transport/decode failures; gather results of any other type are bugs and propagate
+FETCH_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError)
+
+# Token bucket shared by every async fetch: at most 50 Places requests per second
+_limiter = AsyncLimiter(max_rate=50, time_period=1.0)
+
+# One shared session per event loop; an aiohttp session is bound to the loop it was created on
+_aio_sessions = {}
+
+class _LRUCache:
+    """Minimal LRU mapping for responses fetched on the async path."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+# Mirror the cached_nearby_search / cached_place_details LRUs for the async fetchers
+_nearby_cache = _LRUCache(maxsize=200)
+_details_cache = _LRUCache(maxsize=500)
+
+def _get_aio_session():
+    """Return the shared aiohttp session for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    session, _ = _aio_sessions.get(loop, (None, None))
+    if session is None or session.closed:
+        _drop_finished_sessions()
+        # Keep-alive pool sized above the fan-out concurrency so requests never queue on connections
+        connector = aiohttp.TCPConnector(limit=32, limit_per_host=32, keepalive_timeout=30, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+        _aio_sessions[loop] = (session, loop.create_task(_close_on_shutdown(loop, session)))
+    return session
+
+async def _close_on_shutdown(loop, session):
+    # asyncio.run cancels the tasks still pending once its main coroutine returns, so a
+    # short-lived loop closes its session on the way out; long-lived loops keep theirs
+    try:
+        await asyncio.Event().wait()
+    except asyncio.CancelledError:
+        if _aio_sessions.get(loop, (None,))[0] is session:
+            del _aio_sessions[loop]
+        await session.close()
+        raise
+
+def _drop_finished_sessions():
+    # A loop that ended without asyncio.run's task cleanup left its session open; nothing can close it now
+    for loop, (session, _) in list(_aio_sessions.items()):
+        if loop.is_closed():
+            del _aio_sessions[loop]
+            if not session.closed:
+                log.warning("Dropping an aiohttp session left open by a closed event loop")
+
+async def close_aio_session():
+    """Close the running event loop's shared aiohttp session, if it has one."""
+    session, closer = _aio_sessions.pop(asyncio.get_running_loop(), (None, None))
+    if session is not None:
+        closer.cancel()
+        await session.close()
+
+async def _fetch_json(session, semaphore, endpoint, params, no_cache=False):
+    """Async counterpart of _gmaps_get, sharing its disk cache.
+    
+    Disk cache reads and writes are blocking SQLite calls, so they run on worker
+    threads to keep the shared event loop free for other fetches and streaming.
+    """
+    if not no_cache:
+        cached = await asyncio.to_thread(_cache_lookup, endpoint, params)
+        if cached is not None:
+            return cached
+    
+    # aiohttp rejects a None query value with an obscure TypeError; fail clearly instead
+    if not GOOGLE_MAPS_API_KEY:
+        raise ValueError("Google Maps API key not set. Please set GOOGLE_MAPS_API_KEY environment variable.")
+    
+    url = f"{PLACES_API_URL}/{endpoint}/json"
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        async with semaphore, _limiter:
+            async with session.get(url, params={**params, "key": GOOGLE_MAPS_API_KEY}) as resp:
+                if resp.status != 429:
+                    res = orjson.loads(await resp.read())
+                    status = res.get("status")
+                    if status in CACHEABLE_STATUSES:
+                        await asyncio.to_thread(_cache_store, endpoint, params, res)
+                        return res
+                    if status != "OVER_QUERY_LIMIT":
+                        # Same in-body API errors _gmaps_get reports (bad key, invalid request)
+                        log.warning("Google Maps %s returned %s: %s", endpoint, status, res.get("error_message", ""))
+                        return res
+        if attempt < RATE_LIMIT_RETRIES:
+            await asyncio.sleep(0.5 * 2 ** attempt)
+    
+    # Persistent throttling: report it instead of raising so the rest of the fan-out completes
+    log.warning("Rate limited by Google Maps: %s", endpoint)
+    return {"error": "rate_limited"}
+
+async def fetch_nearby(session, semaphore, lat, lng, poi_type, radius=1000, no_cache=False):
+    """Async variant of cached_nearby_search, keyed and queried on quantized coordinates"""
+    lat_q, lng_q = _quantize(lat, lng)
+    params = {
+        "location": f"{lat_q / COORD_QUANTUM},{lng_q / COORD_QUANTUM}",
+        "radius": radius,
+        "type": poi_type
+    }
+    res = await _fetch_json(session, semaphore, "nearbysearch", params, no_cache)
+    results = res.get("results", [])
+    if res.get("status") in CACHEABLE_STATUSES:
+        _nearby_cache.put((lat_q, lng_q, poi_type, radius), results)
+    return results
+
+async def fetch_text_search(session, semaphore, query, lat, lng, radius=5000, no_cache=False):
+    """Async variant of get_places_text_search"""
+    params = {
+        "query": query,
+        "location": f"{lat},{lng}",
+        "radius": radius
+    }
+    res = await _fetch_json(session, semaphore, "textsearch", params, no_cache)
+    return res.get("results", [])
+
+TEXT_SEARCH_GRID_DEG = 0.02  # ~2.2 km cells; well inside the 5 km text-search radius
+
+def _fetch_failed(result):
+    """True for a gathered per-request fetch failure; re-raises any other exception"""
+    if isinstance(result, BaseException):
+        if not isinstance(result, FETCH_ERRORS):
+            raise result
+        return True
+    return False
+
+def _text_search_cell(lat, lng):
+    """Centre of the coarse grid cell that text-search fallbacks near (lat, lng) share"""
+    return (round(round(lat / TEXT_SEARCH_GRID_DEG) * TEXT_SEARCH_GRID_DEG, 4),
+            round(round(lng / TEXT_SEARCH_GRID_DEG) * TEXT_SEARCH_GRID_DEG, 4))
+
+async def _nearby_for_point(session, semaphore, lat, lng, search_term, radius=1000):
+    # Nearby search with the search term as POI type, served from the LRU when possible
+    pois = _nearby_cache.get((*_quantize(lat, lng), search_term, radius))
+    if pois is None:
+        pois = await fetch_nearby(session, semaphore, lat, lng, search_term, radius)
+    return pois
+
+async def get_pois_along_route_async(route_points, search_terms, threshold=5):
+    """Get POIs along route points, issuing all Places calls concurrently
+    
+    Nearby searches run first; points with fewer than threshold results then fall
+    back to text search, one call per coarse grid cell and term rather than per point.
     
     Args:
         route_points: List of (lat, lng) tuples along the route
         search_terms: List of search terms (e.g., ["bar", "restaurant", "museum"])
         threshold: Min results from nearby search before falling back to text search
     """
-    all_pois = []
+    session = _get_aio_session()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
     
-    for lat, lng in route_points:
-        for search_term in search_terms:
-            try:
-                # First try nearby search with the search term as POI type
-                pois = cached_nearby_search(lat, lng, search_term)
-                
-                if len(pois) < threshold:
-                    # Simple fallback - use agent's term directly in text search
-                    try:
-                        search_results = get_places_text_search(f"{search_term} near {lat},{lng}", lat, lng)
-                        pois.extend(search_results)
-                    except:
-                        continue
-                
-                all_pois.extend(pois)
-            except Exception as e:
-                print(f"Error fetching POIs for {search_term}: {e}")
-                continue
+    # Query each grid cell / search term pair once
+    unique_terms = list(dict.fromkeys(search_terms))
+    queries = [(lat, lng, search_term) for lat, lng in dedupe_route_points(route_points) for search_term in unique_terms]
+    nearby_results = await asyncio.gather(
+        *(_nearby_for_point(session, semaphore, lat, lng, search_term) for lat, lng, search_term in queries),
+        return_exceptions=True
+    )
+    
+    # Simple fallback - use agent's term directly in text search, shared by neighbouring sparse points
+    fallback_keys = {}
+    for (lat, lng, search_term), pois in zip(queries, nearby_results):
+        if _fetch_failed(pois):
+            log.warning("Error fetching POIs for %s: %s", search_term, pois)
+        elif len(pois) < threshold:
+            fallback_keys[(lat, lng, search_term)] = (*_text_search_cell(lat, lng), search_term)
+    text_queries = list(dict.fromkeys(fallback_keys.values()))
+    text_results = await asyncio.gather(
+        *(fetch_text_search(session, semaphore, f"{search_term} near {lat},{lng}", lat, lng) for lat, lng, search_term in text_queries),
+        return_exceptions=True
+    )
+    text_pois = {}
+    for (lat, lng, search_term), pois in zip(text_queries, text_results):
+        if _fetch_failed(pois):
+            log.warning("Error fetching POIs for %s: %s", search_term, pois)
+            pois = []
+        text_pois[(lat, lng, search_term)] = pois
+    
+    # Deduplicate by place_id in route order; insertion order keeps downstream scoring stable
+    all_pois: dict[str, dict] = {}
+    for query, pois in zip(queries, nearby_results):
+        if isinstance(pois, BaseException):
+            continue
+        if query in fallback_keys:
+            pois = pois + text_pois[fallback_keys[query]]
+        for poi in pois:
+            place_id = poi.get('place_id')
+            if place_id and place_id not in all_pois:
+                all_pois[place_id] = poi
+    
+    return list(all_pois.values())
+
+async def _run_with_aio_session(coro):
+    try:
+        return await coro
+    finally:
+        await close_aio_session()
+
+@cache
+def _sync_executor():
+    # One worker: its loops run one at a time, so they never fight over the shared aiohttp session
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="places-sync")
+
+def _run_sync(coro):
+    """Run an async fan-out to completion from synchronous code.
+    
+    Uses asyncio.run directly when no event loop is running in this thread; inside a
+    running loop (Streamlit, notebooks) asyncio.run would raise, so the coroutine gets
+    its own loop on a worker thread instead.
+    """
+    coro = _run_with_aio_session(coro)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    return _sync_executor().submit(asyncio.run, coro).result()
+
+def get_pois_along_route(route_points, search_terms, threshold=5):
+    """Synchronous wrapper around get_pois_along_route_async"""
+    return _run_sync(get_pois_along_route_async(route_points, search_terms, threshold))
+
+async def fetch_place_details(session, semaphore, place_id, no_cache=False):
+    """Async variant of get_place_details"""
+    params = {
+        "place_id": place_id,
+        "fields": PLACE_DETAILS_FIELDS
+    }
+    res = await _fetch_json(session, semaphore, "details", params, no_cache)
+    result = res.get("result", {})
+    if res.get("status") in CACHEABLE_STATUSES:
+        _details_cache.put(place_id, result)
+    return result
+
+async def batch_place_details_async(place_ids, max_concurrency=10):
+    """Fetch details for many places concurrently, serving repeats from the in-process cache
+    
+    Returns:
+        list: Details dicts aligned with place_ids ({} for lookups that failed)
+    """
+    session = _get_aio_session()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    
+    details = {}
+    pending = []
+    for place_id in dict.fromkeys(place_ids):
+        cached = _details_cache.get(place_id)
+        if cached is not None:
+            details[place_id] = cached
+        else:
+            pending.append(place_id)
+    
+    results = await asyncio.gather(
+        *(fetch_place_details(session, semaphore, place_id) for place_id in pending),
+        return_exceptions=True
+    )
+    for place_id, result in zip(pending, results):
+        if _fetch_failed(result):
+            log.warning("Error fetching details for %s: %s", place_id, result)
+            result = {}
+        details[place_id] = result
+    
+    return [details[place_id] for place_id in place_ids]
+
+def batch_place_details(place_ids):
+    """Synchronous wrapper around batch_place_details_async"""
+    return _run_sync(batch_place_details_async(place_ids))
+
+_NON_ASCII_RE = re.compile(r'[^\x00-\x7f]+')
+
+def _strip_non_ascii(value):
+    # Remove problematic Unicode characters; most names are already ASCII and skip the regex entirely
+    if isinstance(value, str) and not value.isascii():
+        return _NON_ASCII_RE.sub('', value)
+    return value
+
+@dataclass(slots=True)
+class POI:
+    """Flat POI record used while filtering and scoring; converted with asdict() for the tool result."""
+    # Location & Identity
+    name: str
+    place_id: str
+    lat: float | None
+    lng: float | None
+    formatted_address: str
+    # Quality Indicators
+    rating: float | None
+    user_ratings_total: int | None
+    # Operational Info
+    open_now: bool | None
+    price_level: int | None
+    types: list[str]
+
+def _slim_poi(poi):
+    """Project a raw Places result onto the flat fields the agent needs.
+    
+    Photos, icons, plus codes and the nested geometry are dropped, which keeps the
+    tool result (and the LLM prompt it becomes) small.
+    """
+    location = poi.get('geometry', {}).get('location', {})
+    return POI(
+        # Handle Unicode characters; address falls back to vicinity
+        name=_strip_non_ascii(poi.get('name', '')),
+        place_id=poi.get('place_id', ''),
+        lat=location.get('lat'),
+        lng=location.get('lng'),
+        formatted_address=_strip_non_ascii(poi.get('formatted_address') or poi.get('vicinity') or ''),
+        rating=poi.get('rating'),
+        user_ratings_total=poi.get('user_ratings_total'),
+        open_now=poi.get('opening_hours', {}).get('open_now'),
+        price_level=poi.get('price_level'),
+        types=poi.get('types', []),
+    )
+
+KM_PER_DEGREE = 111.32
+DISTANCE_PENALTY_PER_KM = 10 / KM_PER_DEGREE  # The original 10 points per degree, expressed per km
+MAX_DISTANCE_PENALTY = 30
+
+def _distance_km(lats, lngs, origin_lat, origin_lng):
+    """Equirectangular distance from the origin; accurate to well under 1% at city scale."""
+    dx = (lngs - origin_lng) * math.cos(math.radians(origin_lat))
+    dy = lats - origin_lat
+    return np.hypot(dx, dy) * KM_PER_DEGREE
+
+MMR_DIVERSITY = 0.3  # Weight of geographic redundancy against normalized relevance
+
+def _poi_arrays(pois):
+    """Column arrays (lats, lngs, ratings) for POI records, NaN where a value is unknown.
+    
+    Built once per search so scoring gathers contiguous float64 slices by index
+    instead of walking the POI records again for every category.
+    """
+    lats = np.fromiter((poi.lat or np.nan for poi in pois), dtype=np.float64, count=len(pois))
+    lngs = np.fromiter((poi.lng or np.nan for poi in pois), dtype=np.float64, count=len(pois))
+    ratings = np.fromiter((np.nan if poi.rating is None else poi.rating for poi in pois), dtype=np.float64, count=len(pois))
+    return lats, lngs, ratings
+
+def _score_pois(ratings, lats, lngs, origin_lat, origin_lng):
+    """Vectorized POI scores: rating (max 100 points) minus a capped distance-to-origin penalty."""
+    # Default score for places without rating
+    ratings = np.where(np.isnan(ratings), 3.0, ratings)
+    
+    # Distance penalty (closer to origin is better); no penalty when the location is unknown
+    distance_km = _distance_km(lats, lngs, origin_lat, origin_lng)
+    distance_penalty = np.nan_to_num(np.minimum(distance_km * DISTANCE_PENALTY_PER_KM, MAX_DISTANCE_PENALTY))
+    
+    return np.maximum(ratings * 20 - distance_penalty, 0)
+
+def _mmr_select(scores, lats, lngs, k, diversity=MMR_DIVERSITY):
+    """Maximal-marginal-relevance pick of k indices, best first.
+    
+    Each step takes the POI maximizing relevance minus its similarity to the closest
+    already-picked POI, where similarity is 1 / (1 + distance in km). This keeps five
+    near-identical places on one street from filling a category.
+    """
+    relevance = scores / 100
+    max_similarity = np.zeros(len(scores))
+    available = np.ones(len(scores), dtype=bool)
+    picked = []
     
-    # Deduplicate by place_id
-    unique_pois = {poi.get('place_id'): poi for poi in all_pois if poi.get('place_id')}
-    return list(unique_pois.values())
+    for _ in range(min(k, len(scores))):
+        marginal = np.where(available, relevance - diversity * max_similarity, -np.inf)
+        best = int(np.argmax(marginal))  # Ties keep input order
+        picked.append(best)
+        available[best] = False
+        
+        # Unknown locations carry no redundancy information
+        similarity = 1 / (1 + _distance_km(lats, lngs, lats[best], lngs[best]))
+        max_similarity = np.maximum(max_similarity, np.nan_to_num(similarity))
+    
+    return picked
+
+@lru_cache(maxsize=32)
+def _type_ranks(categories):
+    """Exact-match index from Google place type to category rank, including TYPE_ALIASES."""
+    type_to_rank = {search_term: rank for rank, search_term in enumerate(categories)}
+    for poi_type, search_term in TYPE_ALIASES.items():
+        if search_term in type_to_rank:
+            type_to_rank.setdefault(poi_type, type_to_rank[search_term])
+    return type_to_rank
+
+@lru_cache(maxsize=1024)
+def _fallback_rank(poi_type, categories):
+    """Rank of the first category that contains, or is contained in, poi_type (None if none does)."""
+    return next((rank for rank, category in enumerate(categories) if category in poi_type or poi_type in category), None)
 
 # Agent Tools
-def search_pois_along_route(route_points: list[dict], preference: str, budget_level: str, origin_lat: float, origin_lng: float) -> dict:
+
+# Preference to search terms mapping
+PREFERENCE_TERMS: dict[str, tuple[str, ...]] = {
+    "nightlife": ("bar", "night_club", "restaurant", "movie_theater", "entertainment"),
+    "family-friendly": ("amusement_park", "zoo", "aquarium", "park", "restaurant"),
+    "food": ("restaurant", "cafe", "bakery", "meal_takeaway"),
+    "nature": ("park", "hiking_area", "natural_feature", "campground"),
+    "historical": ("museum", "tourist_attraction", "historical_site", "art_gallery"),
+    "shopping": ("shopping_mall", "store", "clothing_store", "department_store"),
+    "beach": ("beach", "water_sports", "resort", "seafood_restaurant"),
+    "mountains": ("hiking_area", "scenic_lookout", "mountain", "ski_resort"),
+}
+DEFAULT_SEARCH_TERMS: tuple[str, ...] = ("tourist_attraction", "restaurant")
+
+# Budget level to allowed Google price levels
+BUDGET_PRICES: dict[str, frozenset[int]] = {
+    "budget": frozenset({0, 1}),
+    "mid-range": frozenset({1, 2, 3}),
+    "luxury": frozenset({3, 4}),
+}
+DEFAULT_PRICES: frozenset[int] = frozenset({0, 1, 2, 3, 4})
+
+# Google place types that belong to a search term's category without containing its name
+TYPE_ALIASES: dict[str, str] = {
+    "pub": "bar",
+    "coffee_shop": "cafe",
+    "meal_delivery": "meal_takeaway",
+    "casino": "entertainment",
+    "bowling_alley": "entertainment",
+    "amusement_center": "entertainment",
+    "historical_landmark": "historical_site",
+    "monument": "historical_site",
+    "observation_deck": "scenic_lookout",
+    "marina": "water_sports",
+}
+
+async def search_pois_along_route(route_points: list[dict], preference: str, budget_level: str, origin_lat: float, origin_lng: float) -> dict:
     """Retrieves the POIs along the route based on the user's preferences and budget level.
 
     Returns:
         dict: A dictionary containing the POIs or an error message.
     """
     try:
-        print("DEBUG: search_pois_along_route with filtering")
+        log.debug("search_pois_along_route with filtering")
         
-        # Hardcoded preference to search terms mapping
-        preference_mapping = {
-            "nightlife": ["bar", "night_club", "restaurant", "movie_theater", "entertainment"],
-            "family-friendly": ["amusement_park", "zoo", "aquarium", "park", "restaurant"],
-            "food": ["restaurant", "cafe", "bakery", "meal_takeaway"],
-            "nature": ["park", "hiking_area", "natural_feature", "campground"],
-            "historical": ["museum", "tourist_attraction", "historical_site", "art_gallery"],
-            "shopping": ["shopping_mall", "store", "clothing_store", "department_store"],
-            "beach": ["beach", "water_sports", "resort", "seafood_restaurant"],
-            "mountains": ["hiking_area", "scenic_lookout", "mountain", "ski_resort"]
-        }
+        # Normalize once; the LLM may pass "Mid-Range " or "Nightlife"
+        preference = preference.strip().lower()
+        budget_level = budget_level.strip().lower()
         
-        search_terms = preference_mapping.get(preference.lower(), ["tourist_attraction", "restaurant"])
-        print(f"DEBUG: Using search terms for {preference}: {search_terms}")
+        search_terms = PREFERENCE_TERMS.get(preference, DEFAULT_SEARCH_TERMS)
+        log.debug("Using search terms for %s: %s", preference, search_terms)
         
         # Convert route points to tuples
         route_tuples = [(point["lat"], point["lng"]) for point in route_points]
         
         # Get ALL POIs using the flexible function (no limit initially)
-        all_pois = get_pois_along_route(route_tuples, search_terms)
-        print(f"DEBUG: Found {len(all_pois)} total POIs")
+        all_pois = await get_pois_along_route_async(route_tuples, search_terms)
+        log.debug("Found %d total POIs", len(all_pois))
         
         # Budget filtering
-        budget_mapping = {
-            "budget": [0, 1],
-            "mid-range": [1, 2, 3], 
-            "luxury": [3, 4]
-        }
-        allowed_prices = budget_mapping.get(budget_level, [0, 1, 2, 3, 4])
+        allowed_prices = BUDGET_PRICES.get(budget_level, DEFAULT_PRICES)
         
-        # Group POIs by search term category first
-        category_pois = {}
+        # Group POIs by search term category first, as indices into filtered_pois
+        category_indices = {}
         for search_term in search_terms:
-            category_pois[search_term] = []
+            category_indices[search_term] = []
+        
+        # Inverted index from POI type to category rank, so exact matches are hash lookups
+        categories = tuple(category_indices)
+        type_to_rank = _type_ranks(categories)
         
-        # Filter POIs first - remove permanently closed and closed temporarily, and keep only essential fields
+        # Filter, budget-check and categorize in one pass; only POIs that land in a category get slimmed
         filtered_pois = []
         for poi in all_pois:
             # Skip permanently closed places
             if poi.get('permanently_closed', False):
                 continue
             
-            # Skip temporarily closed places
-            if poi.get('business_status') == 'CLOSED_TEMPORARILY':
+            # Skip temporarily (or permanently) closed places
+            if poi.get('business_status') in ('CLOSED_TEMPORARILY', 'CLOSED_PERMANENTLY'):
                 continue
-                
-            # Filter to keep only essential fields
-            filtered_poi = {}
-            
-            # Location & Identity (handle Unicode characters)
-            name = poi.get('name', '')
-            if isinstance(name, str):
-                # Remove or replace problematic Unicode characters
-                try:
-                    name = name.encode('ascii', 'ignore').decode('ascii')
-                except:
-                    name = 'Unknown Place'
-            filtered_poi['name'] = name
-            filtered_poi['place_id'] = poi.get('place_id', '')
-            
-            # Geometry with location
-            geometry = poi.get('geometry', {})
-            if geometry.get('location'):
-                filtered_poi['geometry'] = {
-                    'location': geometry['location']
-                }
-            
-            # Address with fallback (handle Unicode characters)
-            address = ''
-            if poi.get('formatted_address'):
-                address = poi['formatted_address']
-            elif poi.get('vicinity'):
-                address = poi['vicinity']
             
-            if isinstance(address, str):
-                try:
-                    address = address.encode('ascii', 'ignore').decode('ascii')
-                except:
-                    address = 'Unknown Address'
-            filtered_poi['formatted_address'] = address
-            
-            # Quality Indicators
-            filtered_poi['rating'] = poi.get('rating')
-            filtered_poi['user_ratings_total'] = poi.get('user_ratings_total')
-            filtered_poi['business_status'] = poi.get('business_status')
-            
-            # Operational Info
-            if poi.get('opening_hours'):
-                filtered_poi['opening_hours'] = {
-                    'open_now': poi['opening_hours'].get('open_now')
-                }
-            filtered_poi['price_level'] = poi.get('price_level')
-            filtered_poi['types'] = poi.get('types', [])
-            
-            filtered_pois.append(filtered_poi)
-        
-        print(f"DEBUG: Filtered {len(all_pois)} POIs down to {len(filtered_pois)} (removed closed places and excess fields)")
-        
-        # Categorize and filter POIs
-        for poi in filtered_pois:
-            # Check budget first
+            # Check budget
             price_level = poi.get('price_level')
             if price_level is not None and price_level not in allowed_prices:
                 continue  # Skip if doesn't fit budget
                 
             # Categorize by POI types (from the 'types' field)
             poi_types = poi.get('types', [])
-            assigned = False
             
-            for search_term in search_terms:
-                # Check if search_term matches any of the POI's types
-                if search_term in poi_types:
-                    category_pois[search_term].append(poi)
-                    assigned = True
-                    break  # Only add to first matching category
+            # Only add to first matching category, in search term order
+            matched_ranks = [type_to_rank[poi_type] for poi_type in poi_types if poi_type in type_to_rank]
+            if not matched_ranks:
+                # If not assigned to any specific category, try to find best match
+                # (more flexible substring matching for compound terms)
+                matched_ranks = [rank for rank in (_fallback_rank(poi_type, categories) for poi_type in poi_types) if rank is not None]
+            if not matched_ranks:
+                continue
             
-            # If not assigned to any specific category, try to find best match
-            if not assigned:
-                for search_term in search_terms:
-                    # More flexible matching for compound terms
-                    if any(search_term in poi_type or poi_type in search_term for poi_type in poi_types):
-                        category_pois[search_term].append(poi)
-                        break
+            # Keep only essential fields
+            category_indices[categories[min(matched_ranks)]].append(len(filtered_pois))
+            filtered_pois.append(_slim_poi(poi))
         
-        print(f"DEBUG: POIs per category: {[(cat, len(pois)) for cat, pois in category_pois.items()]}")
+        log.debug("Filtered %d POIs down to %d (removed closed, out-of-budget and uncategorized places)", len(all_pois), len(filtered_pois))
+        
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("POIs per category: %s", [(cat, len(indices)) for cat, indices in category_indices.items()])
         
         # Score and get top 5 from each category
+        lats, lngs, ratings = _poi_arrays(filtered_pois)
         final_pois = []
-        for search_term, pois in category_pois.items():
-            if not pois:
-                print(f"DEBUG: No POIs found for category: {search_term}")
+        for search_term, indices in category_indices.items():
+            if not indices:
+                log.debug("No POIs found for category: %s", search_term)
                 continue
                 
-            # Score POIs in this category
-            scored_category_pois = []
-            for poi in pois:
-                score = 0
-                
-                # Rating score
-                rating = poi.get('rating')
-                if rating is not None:
-                    score += rating * 20  # Max 100 points
-                else:
-                    score += 3.0 * 20  # Default score for places without rating
-                
-                # Distance penalty (closer to origin is better)
-                poi_lat = poi.get('geometry', {}).get('location', {}).get('lat')
-                poi_lng = poi.get('geometry', {}).get('location', {}).get('lng')
-                if poi_lat and poi_lng:
-                    distance = ((poi_lat - origin_lat) ** 2 + (poi_lng - origin_lng) ** 2) ** 0.5
-                    distance_penalty = min(distance * 10, 30)
-                    score -= distance_penalty
-                
-                scored_category_pois.append((max(score, 0), poi))
-            
-            # Sort by score and get top 5 from this category
-            scored_category_pois.sort(reverse=True, key=lambda x: x[0])
-            top_5_category = [poi for score, poi in scored_category_pois[:5]]
+            # Score POIs in this category and pick 5 that balance score with geographic diversity
+            cat_lats, cat_lngs = lats[indices], lngs[indices]
+            scores = _score_pois(ratings[indices], cat_lats, cat_lngs, origin_lat, origin_lng)
+            top_5_category = [asdict(filtered_pois[indices[i]]) for i in _mmr_select(scores, cat_lats, cat_lngs, k=5)]
             final_pois.extend(top_5_category)
-            print(f"DEBUG: Added top {len(top_5_category)} POIs from category: {search_term}")
+            log.debug("Added top %d POIs from category: %s", len(top_5_category), search_term)
         
-        print(f"DEBUG: Returning {len(final_pois)} categorized POIs")
-        print("DEBUG: final_pois", final_pois)
+        log.debug("Returning %d categorized POIs", len(final_pois))
+        log.debug("final_pois %s", final_pois)
         return {"pois": final_pois}
     except Exception as e:
         return {"error": f"Error searching POIs: {str(e)}"}
 
+@lru_cache(maxsize=8)
+def _name_automaton(names_lower):
+    """Aho-Corasick automaton mapping each lowercased POI name to the indices of POIs carrying it.
+    
+    Cached on the name tuple so repeated validations of the same POI list (agent retries)
+    reuse the automaton. Returns None when no POI has a name.
+    """
+    name_to_indices = {}
+    for i, name_lower in enumerate(names_lower):
+        if name_lower:
+            name_to_indices.setdefault(name_lower, []).append(i)
+    if not name_to_indices:
+        return None
+    
+    automaton = ahocorasick.Automaton()
+    for name_lower, indices in name_to_indices.items():
+        automaton.add_word(name_lower, indices)
+    automaton.make_automaton()
+    return automaton
+
 def validate_itinerary(itinerary_text: str, original_pois: list[dict]) -> dict:
     """Validates the itinerary for accuracy and prevents hallucination.
     
@@ -364,31 +865,26 @@ def validate_itinerary(itinerary_text: str, original_pois: list[dict]) -> dict:
                 "validation_message": "No POIs provided for validation"
             }
         
-        # Get original POI names for matching
-        original_names = [poi.get('name', '') for poi in original_pois if poi.get('name')]
-        original_names_lower = [name.lower().strip() for name in original_names]
+        # Get original POI names for matching, normalized once per POI
+        poi_names = [poi.get('name', '').strip() for poi in original_pois]
+        named_count = sum(1 for poi in original_pois if poi.get('name'))
         
-        # Extract potential POI mentions from itinerary text
-        # Look for patterns like place names (capitalize words, common POI terms)
-        itinerary_lower = itinerary_text.lower()
+        # Check which of our POIs are mentioned in the itinerary with a single Aho-Corasick pass
+        # (overlapping matches are reported, so "Toit" and "Toit Brewpub" are both found)
+        automaton = _name_automaton(tuple(name.lower() for name in poi_names))
+        mentioned = set()
+        if automaton is not None:
+            for _, indices in automaton.iter(itinerary_text.lower()):
+                mentioned.update(indices)
         
-        valid_pois_used = []
-        
-        # Check which of our POIs are mentioned in the itinerary
-        for i, poi in enumerate(original_pois):
-            poi_name = poi.get('name', '').strip()
-            if not poi_name:
-                continue
-                
-            poi_name_lower = poi_name.lower()
-            
-            # Check if this POI is mentioned (allow partial matches for long names)
-            if poi_name_lower in itinerary_lower:
-                valid_pois_used.append({
-                    'name': poi_name,
-                    'place_id': poi.get('place_id', ''),
-                    'types': poi.get('types', [])
-                })
+        valid_pois_used = [
+            {
+                'name': poi_names[i],
+                'place_id': original_pois[i].get('place_id', ''),
+                'types': original_pois[i].get('types', [])
+            }
+            for i in sorted(mentioned)
+        ]
         
         # For now, we'll focus on preventing hallucination by checking if POIs are from our list
         # Advanced hallucination detection would require NLP to extract all place names
@@ -397,7 +893,7 @@ def validate_itinerary(itinerary_text: str, original_pois: list[dict]) -> dict:
         validation_result = {
             "valid_pois_used": valid_pois_used,
             "used_count": len(valid_pois_used),
-            "total_available_pois": len(original_names),
+            "total_available_pois": named_count,
             "is_valid": True,  # Valid as long as we found some usage of our POIs or no specific places mentioned
             "validation_message": f"Successfully used {len(valid_pois_used)} POIs from search results"
         }
@@ -413,13 +909,12 @@ def validate_itinerary(itinerary_text: str, original_pois: list[dict]) -> dict:
     except Exception as e:
         return {"error": f"Error validating itinerary: {str(e)}"}
 
-# Import required classes for new agent structure
-from google.adk.agents import LlmAgent
-from google.adk.models.lite_llm import LiteLlm
-from google.adk.tools import FunctionTool
-
-def create_itinerary_agent() -> LlmAgent:
+def create_itinerary_agent() -> "LlmAgent":
     """Agent for creating personalized travel itineraries."""
+    # Import required classes for new agent structure; ADK is only loaded once an agent is built
+    from google.adk.agents import LlmAgent
+    from google.adk.tools import FunctionTool
+    
     return LlmAgent(
         model="gemini-2.0-flash",
         name="itinerary_planner",
@@ -438,52 +933,98 @@ def create_itinerary_agent() -> LlmAgent:
     )
 
 
-root_agent = create_itinerary_agent()
-
-# Set up session and runner
-session_service_gemini = InMemorySessionService()
-# Note: Session will be created async when needed
+@cache
+def _root_agent():
+    return create_itinerary_agent()
 
-runner_gemini = Runner(
-    agent=root_agent,
-    app_name="itinerary_planner_app",
-    session_service=session_service_gemini
-)
-
-async def call_agent_async(query: str, runner, user_id, session_id):
-    """Sends a query to the agent and prints the final response."""
-    print(f"\n>>> User Query: {query}")
+def __getattr__(name):
+    # root_agent is built on first access (ADK's loader, the UI runner), so importing the
+    # Maps helpers alone does not pull in ADK
+    if name == "root_agent":
+        return _root_agent()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
+async def stream_agent(query: str, runner, user_id, session_id, run_config=None, partial=False, on_event=None):
+    """Runs the agent and yields (text, is_final) pairs as text-bearing events arrive.
+    
+    By default each complete event's text is yielded. With partial=True and a streaming
+    run_config (StreamingMode.SSE) the model's text deltas are yielded instead, as they
+    arrive; the first delta of a new model turn starts a new paragraph so narration
+    before a tool call does not run into the text after it. on_event, if given, is
+    called with every complete (non-partial) event.
+    
+    The stream ends right after the final response, which is always yielded with
+    is_final=True (its text may be empty).
+    """
+    from google.genai import types
+    
+    configure_genai()
+    
     # Prepare the user's message in ADK format
     content = types.Content(role='user', parts=[types.Part(text=query)])
     
-    final_response_text = "Agent did not produce a final response."
-    
-    # Execute the agent and find the final response
+    streamed = False  # Whether any delta has been yielded yet
+    new_turn = False  # Whether a complete event closed the turn that was streaming
     async for event in runner.run_async(
         user_id=user_id, 
         session_id=session_id, 
-        new_message=content
+        new_message=content,
+        run_config=run_config
     ):
-        print(f"DEBUG: Event - Author: {event.author}, Final: {event.is_final_response()}")
-        print("DEBUG: Event - Content: ", event.content)
-        if event.is_final_response():
-            if event.content and event.content.parts:
-                # Handle text parts only
-                text_parts = [part.text for part in event.content.parts if hasattr(part, 'text') and part.text]
-                if text_parts:
-                    final_response_text = " ".join(text_parts)
-                else:
-                    final_response_text = "Agent completed but returned no text response."
-            break
+        parts = event.content.parts if event.content and event.content.parts else []
+        
+        # Partial events carry streamed text deltas; the aggregated text arrives in a later event
+        if event.partial:
+            delta = "".join(part.text for part in parts if getattr(part, 'text', None))
+            if partial and delta:
+                yield ("\n\n" + delta if new_turn else delta), False
+                streamed, new_turn = True, False
+            continue
+        
+        new_turn = streamed
+        if on_event:
+            on_event(event)
+        is_final = event.is_final_response()
+        log.debug("Event - Author: %s, Final: %s", event.author, is_final)
+        
+        # Handle text parts only
+        text = " ".join(part.text for part in parts if getattr(part, 'text', None))
+        
+        if is_final:
+            if not text and event.actions and event.actions.escalate:
+                text = f"Agent escalated: {event.error_message or 'No specific message.'}"
+            yield text, True
+            return
+        if text and not partial:
+            yield text, False
+
+async def call_agent_async(query: str, runner, user_id, session_id):
+    """Sends a query to the agent and returns the final response."""
+    log.info(">>> User Query: %s", query)
+    
+    final_response_text = "Agent did not produce a final response."
+    async for text, is_final in stream_agent(query, runner, user_id, session_id):
+        if is_final:
+            final_response_text = text or "Agent completed but returned no text response."
             
-    print(f"<<< Agent Response: {final_response_text}")
+    log.info("<<< Agent Response: %s", final_response_text)
     return final_response_text
 
 
 # Test the Gemini agent
 async def test_gemini_agent():
-    print("\n--- Testing Gemini Agent ---")
+    from google.adk.sessions import InMemorySessionService
+    from google.adk.runners import Runner
+    
+    log.info("--- Testing Gemini Agent ---")
+    # Set up session and runner
+    session_service_gemini = InMemorySessionService()
+    runner_gemini = Runner(
+        agent=_root_agent(),
+        app_name="itinerary_planner_app",
+        session_service=session_service_gemini
+    )
+    
     # Create session first
     await session_service_gemini.create_session(
         app_name="itinerary_planner_app",
@@ -491,8 +1032,9 @@ async def test_gemini_agent():
         session_id="session_gemini"
     )
     
-    await call_agent_async(
-        '''Create a 1-day itinerary from Whitefield, Bengaluru, Karnataka, India to Yelahanka, Bengaluru, Karnataka, India.
+    try:
+        await call_agent_async(
+            '''Create a 1-day itinerary from Whitefield, Bengaluru, Karnataka, India to Yelahanka, Bengaluru, Karnataka, India.
 
 Route Information:
 - Route points: [{'lat': 12.9698235, 'lng': 77.7499503}, {'lat': 12.9830082, 'lng': 77.7522048}, {'lat': 12.987888, 'lng': 77.7334051}, {'lat': 12.9842764, 'lng': 77.7290893}, {'lat': 12.9865946, 'lng': 77.7317473}, {'lat': 12.9881541, 'lng': 77.731731}, {'lat': 12.9917587, 'lng': 77.7155816}, {'lat': 12.9910054, 'lng': 77.7147251}, {'lat': 12.9903995, 'lng': 77.7140484}, {'lat': 13.0002981, 'lng': 77.68074849999999}, {'lat': 13.0419689, 'lng': 77.5938994}, {'lat': 13.0426893, 'lng': 77.590401}, {'lat': 13.0949516, 'lng': 77.5975587}, {'lat': 13.0950005, 'lng': 77.59742589999999}, {'lat': 13.1154543, 'lng': 77.6070896}, {'lat': 13.1154897, 'lng': 77.60700849999999}]
@@ -503,10 +1045,15 @@ User Preferences:
 - Budget: mid-range
 - Preference: nightlife
 ''',
-        runner=runner_gemini,
-        user_id="user_1",
-        session_id="session_gemini"
-    )
+            runner=runner_gemini,
+            user_id="user_1",
+            session_id="session_gemini"
+        )
+    finally:
+        # The agent's POI searches ran on this loop's shared aiohttp session
+        await close_aio_session()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    log.setLevel(logging.DEBUG)  # Show POI discovery details when run directly
     asyncio.run(test_gemini_agent())
\ No newline at end of file
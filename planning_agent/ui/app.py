@@ -3,51 +3,178 @@ import folium
 from streamlit_folium import st_folium
 import sys
 import os
+import logging
+from collections import deque
 import asyncio
-from google.adk.sessions import InMemorySessionService
-from google.adk.runners import Runner
-from google.genai import types
+import threading
+import queue
+import uuid
+import numpy as np
 
 # Import all agent functions
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'agent'))
 from agent import (
-    get_directions, get_place_autocomplete, get_place_details, 
+    get_directions, get_place_autocomplete,
     get_places_nearby, get_places_text_search, cached_place_details, 
     cached_nearby_search, sample_route_points, get_pois_along_route,
     search_pois_along_route, validate_itinerary,
-    root_agent
+    batch_place_details_async, stream_agent, CACHE_TTLS
 )
 
-# Setup Session Service and Runner
-session_service = InMemorySessionService()
+log = logging.getLogger(__name__)
 
 # Define constants for identifying the interaction context  
 APP_NAME = "itinerary_planner_app"
 USER_ID = "user_1" 
-SESSION_ID = "session_001"
 
-# Create the session
-session = asyncio.run(session_service.create_session(
-    app_name=APP_NAME,
-    user_id=USER_ID,
-    session_id=SESSION_ID
-))
-print(f"Session created: App='{APP_NAME}', User='{USER_ID}', Session='{SESSION_ID}'")
+@st.cache_resource
+def background_loop():
+    """One long-lived event loop on a daemon thread, shared by every rerun.
+    
+    Keeps the agent's aiohttp pools and the ADK runner on a single loop instead of
+    a fresh asyncio.run loop per click.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-loop", daemon=True).start()
+    return loop
 
-# Create the runner
-runner = Runner(
-    agent=root_agent,
-    app_name=APP_NAME,
-    session_service=session_service
-)
+def run_async(coro):
+    """Run a coroutine on the background loop and block until it finishes"""
+    return asyncio.run_coroutine_threadsafe(coro, background_loop()).result()
+
+@st.cache_resource
+def agent_runtime():
+    """Setup Session Service and Runner once per server process, on the first itinerary"""
+    # ADK is only needed once an itinerary is requested; keep it off the first page render
+    from google.adk.sessions import InMemorySessionService
+    from google.adk.runners import Runner
+    from agent import root_agent
+    
+    session_service = InMemorySessionService()
+    
+    # Create the runner; generate_itinerary_async creates a session per itinerary
+    runner = Runner(
+        agent=root_agent,
+        app_name=APP_NAME,
+        session_service=session_service
+    )
+    return session_service, runner
 
 # Removed rigid mappings - Agent will intelligently handle POI discovery and categorization
 
-async def generate_itinerary_async(route_points, num_days, preference, budget_level, origin_name, destination_name, origin_lat, origin_lng):
-    """Generate intelligent itinerary using ADK Agent with async session management"""
+# Shorter prefixes return noisy suggestions and burn autocomplete quota
+MIN_AUTOCOMPLETE_CHARS = 4
+
+# Marker styles; folium.Icon instances belong to one marker each, so only the settings are shared
+ORIGIN_ICON = {"color": "green", "icon": "play"}
+DEST_ICON = {"color": "red", "icon": "stop"}
+
+ROUTE_SIMPLIFY_TOLERANCE = 1e-4  # Degrees (~11 m), invisible at the map's zoom levels
+
+def simplify_path(coords, tolerance=ROUTE_SIMPLIFY_TOLERANCE):
+    """Ramer-Douglas-Peucker simplification of [lat, lng] points; the endpoints are always kept"""
+    coords = np.asarray(coords, dtype=np.float64)
+    if len(coords) < 3:
+        return coords.tolist()
     
-    # Build the query string for the agent
-    query = f"""Create a {num_days}-day itinerary from {origin_name} to {destination_name}.
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(coords) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        # Perpendicular distance of the interior points from the start-end chord
+        chord = coords[end] - coords[start]
+        offsets = coords[start + 1:end] - coords[start]
+        chord_len = np.hypot(chord[0], chord[1])
+        if chord_len == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / chord_len
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.extend(((start, split), (split, end)))
+    return coords[keep].tolist()
+
+# Streamlit reruns the whole script on every widget interaction; memoize the Maps lookups across reruns
+@st.cache_data(ttl=CACHE_TTLS["autocomplete"], show_spinner=False)
+def place_autocomplete(query):
+    return get_place_autocomplete(query)
+
+class DetailsLookupFailed(Exception):
+    """Raised out of places_details so st.cache_data does not keep a batch with failed lookups"""
+    def __init__(self, details):
+        super().__init__("Place details lookup failed")
+        self.details = details
+
+@st.cache_data(ttl=3600, max_entries=500, show_spinner=False)
+def _cached_places_details(place_ids):
+    # Origin and destination lookups run concurrently on the background loop
+    details = run_async(batch_place_details_async(list(place_ids)))
+    if not all(details):
+        # Failed lookups come back as {}; caching them would pin "Could not locate" for the whole TTL
+        raise DetailsLookupFailed(details)
+    return details
+
+def places_details(place_ids):
+    """Details for place_ids, aligned with them; {} for lookups that failed and are retried on the next rerun"""
+    try:
+        return _cached_places_details(place_ids)
+    except DetailsLookupFailed as e:
+        return e.details
+
+@st.cache_data(ttl=3600, max_entries=200, show_spinner=False)
+def route_directions(origin, destination):
+    return get_directions(origin, destination)
+
+def stream_itinerary(placeholder, *args):
+    """Run generate_itinerary_async on the background loop, rendering streamed text into placeholder"""
+    # Streamlit elements can only be updated from the script thread, so deltas cross over a queue
+    deltas = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(generate_itinerary_async(*args, on_text=deltas.put), background_loop())
+    streamed = ""
+    while not (future.done() and deltas.empty()):
+        try:
+            streamed += deltas.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        placeholder.markdown(streamed)
+    placeholder.empty()
+    return future.result()
+
+@st.cache_data(max_entries=50, show_spinner=False)
+def route_sample(route_id, _directions):
+    # Keyed on route_id (the encoded overview polyline); the directions payload itself is not hashed
+    return sample_route_points(_directions)
+
+# Only the view settings are shared; st_folium reparents and renders the map it is given, so each rerun
+# builds its own (about a millisecond) rather than racing other sessions on one instance
+DEFAULT_MAP_VIEW = {"location": (40.7128, -74.0060), "zoom_start": 10}  # Default to NYC
+
+def location_data(column, choice, details):
+    """Map data for a chosen suggestion, confirming the choice under its input (None if it has no usable location)"""
+    location = details.get("geometry", {}).get("location", {})
+    lat, lng = location.get("lat"), location.get("lng")
+    
+    with column:
+        if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            st.error(f"Could not locate {choice['description']}")
+            return None
+        st.success(f"📍 {choice['description']}")
+    return {
+        "name": choice["description"],
+        "lat": lat,
+        "lng": lng,
+        "coordinates": f"{lat},{lng}"
+    }
+
+DEBUG_EVENT_LIMIT = 100  # Long tool-calling runs keep only their latest events for the debug view
+
+# Agent query, filled per generation; kept as one template so the prompt wording lives in one place
+PROMPT_TEMPLATE = """Create a {num_days}-day itinerary from {origin_name} to {destination_name}.
 
 Route Information:
 - Route points: {route_points}
@@ -59,46 +186,71 @@ User Preferences:
 - Preference: {preference}
 """
 
-    print(f"\n>>> User Query: {query}")
+async def generate_itinerary_async(route_points, num_days, preference, budget_level, origin_name, destination_name, origin_lat, origin_lng, on_text=None):
+    """Generate intelligent itinerary using ADK Agent with async session management
     
-    # Prepare the user's message in ADK format
-    content = types.Content(role='user', parts=[types.Part(text=query)])
+    on_text, if given, is called with each streamed text delta as the model produces it.
+    """
+    
+    # Build the query string for the agent
+    query = PROMPT_TEMPLATE.format(
+        num_days=num_days,
+        origin_name=origin_name,
+        destination_name=destination_name,
+        route_points=route_points,
+        origin_lat=origin_lat,
+        origin_lng=origin_lng,
+        budget_level=budget_level,
+        preference=preference
+    )
+
+    from google.adk.agents.run_config import RunConfig, StreamingMode
+    
+    log.info(">>> User Query: %s", query)
+    session_service, runner = agent_runtime()
+    
+    # The runner is shared by every browser session; a fresh session id per itinerary keeps
+    # concurrent generations in separate, empty conversations
+    session_id = uuid.uuid4().hex
+    await session_service.create_session(app_name=APP_NAME, user_id=USER_ID, session_id=session_id)
+    log.info("Session created: App='%s', User='%s', Session='%s'", APP_NAME, USER_ID, session_id)
     
     final_response_text = "Agent did not produce a final response."  # Default
-    debug_events = []  # Store debug information
+    debug_events = deque(maxlen=DEBUG_EVENT_LIMIT)  # Store debug information, newest events only
+    
+    def record_event(event):
+        # Debug: Store event information
+        debug_info = f"[Event] Author: {event.author}, Type: {type(event).__name__}, Final: {event.is_final_response()}"
+        debug_events.append(debug_info)
+        log.debug("debugInfo %s", debug_info)
     
     try:
-        # Run the agent and process events
-        async for event in runner.run_async(user_id=USER_ID, session_id=SESSION_ID, new_message=content):
-            # Debug: Store event information
-            debug_info = f"[Event] Author: {event.author}, Type: {type(event).__name__}, Final: {event.is_final_response()}"
-            debug_events.append(debug_info)
-            print("DEBUG: debugInfo ", debug_info)
-            
-            # Check for final response
-            if event.is_final_response():
-                if event.content and event.content.parts:
-                    # Get text response from the first part
-                    final_response_text = event.content.parts[0].text
-                elif event.actions and event.actions.escalate:
-                    # Handle escalations
-                    final_response_text = f"Agent escalated: {event.error_message or 'No specific message.'}"
-                break  # Stop processing events once final response is found
+        # Run the agent, streaming text deltas to on_text until the final response
+        run_config = RunConfig(streaming_mode=StreamingMode.SSE)
+        async for text, is_final in stream_agent(query, runner, USER_ID, session_id,
+                                                 run_config=run_config, partial=True, on_event=record_event):
+            if is_final:
+                final_response_text = text or final_response_text
+            elif on_text:
+                on_text(text)
                 
-        print(f"<<< Agent Response: {final_response_text}")
+        log.info("<<< Agent Response: %s", final_response_text)
         
         return {
             "itinerary": final_response_text,
-            "debug_events": debug_events
+            "debug_events": list(debug_events)
         }
         
     except Exception as e:
         error_msg = f"Error generating itinerary: {str(e)}"
-        print(error_msg)
+        log.exception(error_msg)
         return {
             "itinerary": error_msg,
-            "debug_events": debug_events
+            "debug_events": list(debug_events)
         }
+    finally:
+        # The in-memory service would otherwise keep every finished conversation
+        await session_service.delete_session(app_name=APP_NAME, user_id=USER_ID, session_id=session_id)
 
 st.title("🗺️ Itinerary Route Planner")
 
@@ -127,10 +279,10 @@ col1, col2 = st.columns(2)
 with col1:
     st.subheader("🚩 Origin")
     origin_query = st.text_input("Start typing origin...", key="origin_input")
-    origin_data = None
+    origin_selected = None
     
-    if origin_query and len(origin_query) > 2:
-        origin_suggestions = get_place_autocomplete(origin_query)
+    if origin_query and len(origin_query) >= MIN_AUTOCOMPLETE_CHARS:
+        origin_suggestions = place_autocomplete(origin_query)
         if origin_suggestions:
             origin_choice = st.selectbox(
                 "Origin Suggestions:",
@@ -139,27 +291,16 @@ with col1:
             )
             
             if origin_choice:
-                selected = next(s for s in origin_suggestions if s["description"] == origin_choice)
-                details = get_place_details(selected["place_id"])
-                lat = details["geometry"]["location"]["lat"]
-                lng = details["geometry"]["location"]["lng"]
-                
-                st.success(f"📍 {origin_choice}")
-                origin_data = {
-                    "name": origin_choice,
-                    "lat": lat,
-                    "lng": lng,
-                    "coordinates": f"{lat},{lng}"
-                }
+                origin_selected = next(s for s in origin_suggestions if s["description"] == origin_choice)
 
 # Destination selection  
 with col2:
     st.subheader("🏁 Destination")
     dest_query = st.text_input("Start typing destination...", key="dest_input")
-    dest_data = None
+    dest_selected = None
     
-    if dest_query and len(dest_query) > 2:
-        dest_suggestions = get_place_autocomplete(dest_query)
+    if dest_query and len(dest_query) >= MIN_AUTOCOMPLETE_CHARS:
+        dest_suggestions = place_autocomplete(dest_query)
         if dest_suggestions:
             dest_choice = st.selectbox(
                 "Destination Suggestions:",
@@ -168,46 +309,70 @@ with col2:
             )
             
             if dest_choice:
-                selected = next(s for s in dest_suggestions if s["description"] == dest_choice)
-                details = get_place_details(selected["place_id"])
-                lat = details["geometry"]["location"]["lat"]
-                lng = details["geometry"]["location"]["lng"]
-                
-                st.success(f"📍 {dest_choice}")
-                dest_data = {
-                    "name": dest_choice,
-                    "lat": lat,
-                    "lng": lng,
-                    "coordinates": f"{lat},{lng}"
-                }
+                dest_selected = next(s for s in dest_suggestions if s["description"] == dest_choice)
+
+# Start the route lookup (by place_id, so it needs no coordinates) before resolving details, so the two
+# overlap; its result is only used if both sides validate below
+route_future = None
+if origin_selected and dest_selected and origin_selected["place_id"] != dest_selected["place_id"]:
+    pair_key = (f"place_id:{origin_selected['place_id']}", f"place_id:{dest_selected['place_id']}")
+    if st.session_state.get("route_key") != pair_key:
+        route_future = asyncio.run_coroutine_threadsafe(asyncio.to_thread(route_directions, *pair_key), background_loop())
+
+# Resolve both selections with one concurrent details lookup
+selected_ids = tuple(s["place_id"] for s in (origin_selected, dest_selected) if s)
+details_by_id = dict(zip(selected_ids, places_details(selected_ids))) if selected_ids else {}
+origin_data = location_data(col1, origin_selected, details_by_id[origin_selected["place_id"]]) if origin_selected else None
+dest_data = location_data(col2, dest_selected, details_by_id[dest_selected["place_id"]]) if dest_selected else None
+
+# Use the route only once both sides have validated locations, and not between two choices at one point
+route_key = None
+same_place = bool(origin_data and dest_data and (
+    origin_selected["place_id"] == dest_selected["place_id"]
+    or origin_data["coordinates"] == dest_data["coordinates"]
+))
+if origin_data and dest_data and not same_place:
+    route_key = pair_key
 
 # Show map and route
 st.subheader("🗺️ Map")
 
-if origin_data and dest_data:
-    # Get route using existing get_directions function
+if origin_data and dest_data and same_place:
+    # Nothing to route; skip the map render (a started lookup for distinct place_ids is ignored)
+    st.warning("Origin and destination are the same place. Choose a different destination to plan a route.")
+elif origin_data and dest_data:
+    # Get route using existing get_directions function, once per origin/destination pair
     try:
-        directions = get_directions(origin_data["coordinates"], dest_data["coordinates"])
+        if route_future is not None:
+            st.session_state["directions"] = route_future.result()
+            st.session_state["route_coords"] = None
+            st.session_state["route_key"] = route_key
+        directions = st.session_state["directions"]
         
         if directions:
             # Create map centered between origin and destination
             center_lat = (origin_data["lat"] + dest_data["lat"]) / 2
             center_lng = (origin_data["lng"] + dest_data["lng"]) / 2
-            m = folium.Map(location=[center_lat, center_lng], zoom_start=12)
+            # Canvas renderer draws the route as one bitmap layer instead of SVG path nodes
+            m = folium.Map(location=[center_lat, center_lng], zoom_start=12, prefer_canvas=True)
+            
+            # Endpoint markers share one layer, attached to the map once
+            endpoints = folium.FeatureGroup(name="Endpoints")
             
             # Add origin marker
             folium.Marker(
                 [origin_data["lat"], origin_data["lng"]], 
                 tooltip=f"Origin: {origin_data['name']}",
-                icon=folium.Icon(color='green', icon='play')
-            ).add_to(m)
+                icon=folium.Icon(**ORIGIN_ICON)
+            ).add_to(endpoints)
             
             # Add destination marker
             folium.Marker(
                 [dest_data["lat"], dest_data["lng"]], 
                 tooltip=f"Destination: {dest_data['name']}",
-                icon=folium.Icon(color='red', icon='stop')
-            ).add_to(m)
+                icon=folium.Icon(**DEST_ICON)
+            ).add_to(endpoints)
+            endpoints.add_to(m)
             
             # Draw route
             route = directions[0]
@@ -217,24 +382,36 @@ if origin_data and dest_data:
             st.info(f"**Distance:** {legs['distance']['text']} | **Duration:** {legs['duration']['text']}")
             
             # Extract route coordinates and draw line
-            route_coords = []
-            for step in legs['steps']:
-                route_coords.append([step['start_location']['lat'], step['start_location']['lng']])
-            route_coords.append([legs['end_location']['lat'], legs['end_location']['lng']])
+            route_coords = st.session_state["route_coords"]
+            if route_coords is None:
+                # Step start points plus the end location, filled straight into one (n + 1, 2) array
+                steps = legs['steps']
+                coords = np.empty((len(steps) + 1, 2))
+                for i, step in enumerate(steps):
+                    coords[i] = (step['start_location']['lat'], step['start_location']['lng'])
+                coords[-1] = (legs['end_location']['lat'], legs['end_location']['lng'])
+                # Fewer vertices means less HTML serialized and shipped to the browser on each rerun
+                route_coords = simplify_path(coords)
+                st.session_state["route_coords"] = route_coords
             
-            folium.PolyLine(route_coords, weight=5, color='blue', opacity=0.8).add_to(m)
+            folium.PolyLine(route_coords, weight=5, color='blue', opacity=0.8, smooth_factor=2.0).add_to(m)
             
-            st_folium(m, width=700, height=500)
+            # returned_objects=[]: pan/zoom stay client-side instead of rerunning the script
+            st_folium(m, width=700, height=500, returned_objects=[])
             
-            # Generate Itinerary Section
+            # Generate Itinerary Section; the result is kept per route and preferences so later reruns redisplay it.
+            # An explicit click always regenerates, so a failed or unwanted result can be retried as is
+            itinerary_key = (route_key, num_days, preference, budget_level)
             if generate_itinerary:
                 st.markdown("---")
                 st.subheader("🤖 Intelligent Agent Creating Your Itinerary...")
                 
+                # Generate route points for agent, once per route
+                route_points = route_sample(route.get('overview_polyline', {}).get('points', str(route_key)), directions)
+                
                 # DEBUG: Show input to agent
                 with st.expander("🔍 DEBUG: Agent Input", expanded=False):
                     st.write("**Input sent to Intelligent Agent:**")
-                    route_points = sample_route_points(directions)
                     agent_input = {
                         "origin": origin_data["name"],
                         "destination": dest_data["name"], 
@@ -249,14 +426,12 @@ if origin_data and dest_data:
                 
                 with st.spinner("Agent is intelligently discovering POIs and creating your itinerary..."):
                     try:
-                        # Generate route points for agent
-                        route_points = sample_route_points(directions)
-                        
                         # Convert route points to format agent expects
                         route_points_for_agent = [{"lat": lat, "lng": lng} for lat, lng in route_points]
                         
-                        # Call intelligent agent using asyncio
-                        result = asyncio.run(generate_itinerary_async(
+                        # Call intelligent agent on the shared background loop, showing text as it streams
+                        result = stream_itinerary(
+                            st.empty(),
                             route_points_for_agent,
                             num_days, 
                             preference, 
@@ -265,36 +440,39 @@ if origin_data and dest_data:
                             dest_data["name"],
                             origin_data["lat"], 
                             origin_data["lng"]
-                        ))
-                        
-                        itinerary = result["itinerary"]
-                        debug_events = result["debug_events"]
-                        
-                        # DEBUG: Show agent output and events
-                        with st.expander("🔍 DEBUG: Agent Output & Events", expanded=False):
-                            st.write("**Debug Events:**")
-                            for event in debug_events:
-                                st.text(event)
-                            st.write("**Raw Agent Response:**")
-                            st.text(itinerary[:500] + "..." if len(itinerary) > 500 else itinerary)
-                        
-                        # Display the final itinerary
-                        st.success("✅ Your Intelligent Itinerary is Ready!")
-                        st.markdown(itinerary)
-                        
-                        # Show summary
-                        st.subheader("🤖 AI Agent Summary")
-                        col1, col2, col3 = st.columns(3)
-                        with col1:
-                            st.metric("Days Planned", num_days)
-                        with col2:
-                            st.metric("Budget Level", budget_level.title())
-                        with col3:
-                            st.metric("Preference", preference.title().replace('-', ' '))
+                        )
+                        st.session_state["itinerary_result"] = result
+                        st.session_state["itinerary_key"] = itinerary_key
                         
                     except Exception as e:
                         st.error(f"Error generating itinerary: {e}")
                         st.exception(e)
+            
+            if st.session_state.get("itinerary_key") == itinerary_key:
+                result = st.session_state["itinerary_result"]
+                itinerary = result["itinerary"]
+                debug_events = result["debug_events"]
+                
+                # DEBUG: Show agent output and events
+                with st.expander("🔍 DEBUG: Agent Output & Events", expanded=False):
+                    st.write("**Debug Events:**")
+                    st.text("\n".join(debug_events))
+                    st.write("**Raw Agent Response:**")
+                    st.text(itinerary[:500] + "..." if len(itinerary) > 500 else itinerary)
+                
+                # Display the final itinerary
+                st.success("✅ Your Intelligent Itinerary is Ready!")
+                st.markdown(itinerary)
+                
+                # Show summary
+                st.subheader("🤖 AI Agent Summary")
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("Days Planned", num_days)
+                with col2:
+                    st.metric("Budget Level", budget_level.title())
+                with col3:
+                    st.metric("Preference", preference.title().replace('-', ' '))
         else:
             st.error("Could not find route")
     except Exception as e:
@@ -304,12 +482,10 @@ elif origin_data or dest_data:
     # Show single location
     location = origin_data or dest_data
     m = folium.Map(location=[location["lat"], location["lng"]], zoom_start=14)
-    color = 'green' if origin_data else 'red' 
-    icon = 'play' if origin_data else 'stop'
+    icon = ORIGIN_ICON if origin_data else DEST_ICON
     folium.Marker([location["lat"], location["lng"]], tooltip=location['name'], 
-                 icon=folium.Icon(color=color, icon=icon)).add_to(m)
-    st_folium(m, width=700, height=500)
+                 icon=folium.Icon(**icon)).add_to(m)
+    st_folium(m, width=700, height=500, returned_objects=[])
 else:
     # Default map
-    m = folium.Map(location=[40.7128, -74.0060], zoom_start=10)  # Default to NYC
-    st_folium(m, width=700, height=500)
+    st_folium(folium.Map(**DEFAULT_MAP_VIEW), width=700, height=500, returned_objects=[])